@@ -1,17 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+# Patch before anything imports socket/ssl. Blocking Firebase and SMTP
+# calls then yield to other greenlets, so route handlers stay synchronous
+# and gevent is the only concurrency model in the app.
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify, abort
 from flask_mail import Mail, Message
+from flask_caching import Cache
 import firebase_admin
-from firebase_admin import credentials, db
-from datetime import datetime
+from firebase_admin import credentials, db, exceptions
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from dotenv import load_dotenv
-import json
+import atexit
+import hmac
+import orjson
 import os
+import queue
+import threading
+import time
 
 # ---------------------------------------
 # LOAD ENVIRONMENT VARIABLES
 # ---------------------------------------
 load_dotenv()
 
+ADMIN_EMAIL = os.getenv("MAIL_USERNAME")
+
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
 
@@ -21,16 +40,113 @@ app.secret_key = os.getenv("SECRET_KEY")
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
 app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = os.getenv("MAIL_USERNAME")
+app.config['MAIL_USERNAME'] = ADMIN_EMAIL
 app.config['MAIL_PASSWORD'] = os.getenv("MAIL_PASSWORD")
-app.config['MAIL_DEFAULT_SENDER'] = ('Bakholokoe Game Lodge', os.getenv("MAIL_USERNAME"))
+app.config['MAIL_DEFAULT_SENDER'] = ('Bakholokoe Game Lodge', ADMIN_EMAIL)
 
 mail = Mail(app)
 
+# Outgoing mail is handed to a background worker so request handlers
+# never block on the SMTP round-trip. Everything waiting in the queue is
+# sent over a single SMTP connection (e.g. both contact emails).
+mail_queue = queue.Queue()
+
+def drain_mail_queue(batch):
+    while True:
+        try:
+            batch.append(mail_queue.get_nowait())
+        except queue.Empty:
+            return batch
+
+def send_batch(batch):
+    try:
+        with app.app_context(), mail.connect() as conn:
+            for msg in batch:
+                try:
+                    conn.send(msg)
+                except Exception:
+                    app.logger.exception("Failed to send email: %s", msg.subject)
+    except Exception:
+        app.logger.exception("Failed to connect to mail server")
+
+def mail_worker():
+    while True:
+        batch = drain_mail_queue([mail_queue.get()])
+        try:
+            send_batch(batch)
+        finally:
+            for _ in batch:
+                mail_queue.task_done()
+
+threading.Thread(target=mail_worker, daemon=True).start()
+
 def send_email(subject, recipient, body):
     msg = Message(subject, recipients=[recipient])
     msg.body = body
-    mail.send(msg)
+    mail_queue.put(msg)
+
+# Booking notifications are held for up to NOTIFY_INTERVAL seconds (or
+# NOTIFY_BATCH_SIZE bookings) and then queued together, so a burst of
+# bookings goes out over one SMTP session per window *per process*: each
+# gunicorn worker (4 in the Procfile) batches on its own, so a burst can
+# still open up to one session per worker. Held notifications live only
+# in memory and are lost if a worker is killed without a graceful exit
+# (SIGKILL, worker timeout); the booking itself is already in Firebase.
+NOTIFY_INTERVAL = 30
+NOTIFY_BATCH_SIZE = 20
+
+pending_notifications = []
+notify_lock = threading.Lock()
+notify_timer = None
+
+def flush_notifications():
+    global notify_timer
+    with notify_lock:
+        batch = pending_notifications[:]
+        pending_notifications.clear()
+        if notify_timer is not None:
+            notify_timer.cancel()
+            notify_timer = None
+
+    for msg in batch:
+        mail_queue.put(msg)
+
+def notify_admin(subject, body):
+    global notify_timer
+    msg = Message(subject, recipients=[ADMIN_EMAIL])
+    msg.body = body
+
+    with notify_lock:
+        pending_notifications.append(msg)
+        if len(pending_notifications) < NOTIFY_BATCH_SIZE:
+            if notify_timer is None:
+                notify_timer = threading.Timer(NOTIFY_INTERVAL, flush_notifications)
+                notify_timer.daemon = True
+                notify_timer.start()
+            return
+
+    flush_notifications()
+
+@atexit.register
+def send_pending_mail():
+    # The mail worker is a daemon thread and dies with the process, so on a
+    # graceful shutdown (deploy, worker recycle) send what is left directly.
+    # atexit does not run on SIGKILL or a gunicorn worker timeout.
+    flush_notifications()
+    batch = drain_mail_queue([])
+    if batch:
+        send_batch(batch)
+
+# ---------------------------------------
+# PAGE CACHE
+# ---------------------------------------
+app.config['CACHE_TYPE'] = 'SimpleCache'
+
+cache = Cache(app)
+
+def is_personalised():
+    # The navbar shows the signed-in user, so only anonymous pages are cached
+    return request.method == "POST" or "user" in session
 
 # ---------------------------------------
 # FIREBASE INITIALIZATION FOR RENDER
@@ -43,8 +159,8 @@ if not firebase_admin._apps:
         raise RuntimeError("❌ Missing FIREBASE_KEY_JSON in Render environment settings!")
 
     try:
-        firebase_credentials = json.loads(firebase_credentials_raw)
-    except json.JSONDecodeError:
+        firebase_credentials = orjson.loads(firebase_credentials_raw)
+    except orjson.JSONDecodeError:
         raise RuntimeError("❌ FIREBASE_KEY_JSON contains invalid JSON. Fix it in Render.")
 
     cred = credentials.Certificate(firebase_credentials)
@@ -53,37 +169,165 @@ if not firebase_admin._apps:
         "databaseURL": os.getenv("DATABASE_URL")
     })
 
+    # firebase_admin reuses one keep-alive session per database, but its
+    # default pool only holds 10 connections; give concurrent greenlets more.
+    # This depends on firebase_admin internals (Reference._client.session,
+    # as of 7.1.0), so leave the default pool alone if they change.
+    firebase_client = getattr(db.reference(), "_client", None)
+    firebase_session = getattr(firebase_client, "session", None)
+
+    if firebase_session is not None:
+        firebase_session.mount("https://", HTTPAdapter(
+            pool_maxsize=32,
+            max_retries=firebase_session.get_adapter("https://").max_retries
+        ))
+    else:
+        app.logger.warning("firebase_admin internals changed; using its default connection pool")
+
 # ---------------------------------------
 # HELPER FUNCTIONS
 # ---------------------------------------
+# Characters Firebase does not allow in keys
+EMAIL_KEY_TABLE = str.maketrans({'.': '_', '#': '_', '$': '_', '[': '_', ']': '_'})
+
 def format_email_key(email):
-    return email.replace('.', '_')
+    return email.translate(EMAIL_KEY_TABLE)
+
+# Cost follows the OWASP argon2id minimum (19 MiB, 2 passes, 1 lane) rather
+# than the library default (64 MiB, 3 passes, 4 lanes): each hash runs on a
+# shared gevent worker, so keep it around tens of milliseconds
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19 * 1024, parallelism=1)
+
+# argon2 is native code that never yields, so run it on the hub's
+# threadpool instead of stalling every other greenlet on the worker
+def hash_password(password):
+    return gevent.get_hub().threadpool.apply(password_hasher.hash, (password,))
+
+def verify_password(stored, password):
+    def verify():
+        try:
+            return password_hasher.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    return gevent.get_hub().threadpool.apply(verify)
+
+# Users are cached per request on flask.g and briefly across requests;
+# save_user() invalidates the shared entry.
+user_cache = TTLCache(maxsize=1024, ttl=60)
 
 def get_user(email):
-    return db.reference(f"users/{format_email_key(email)}").get()
+    if "user_cache" not in g:
+        g.user_cache = {}
+    if email in g.user_cache:
+        return g.user_cache[email]
+
+    user = user_cache.get(email)
+    if user is None:
+        user = db.reference(f"users/{format_email_key(email)}").get()
+        if user is not None:
+            user_cache[email] = user
+
+    g.user_cache[email] = user
+    return user
 
 def save_user(email, name, password):
-    db.reference(f"users/{format_email_key(email)}").set({
+    user_cache.pop(email, None)
+    g.pop("user_cache", None)
+    db.reference(f"users/{format_email_key(email)}").update({
         "name": name,
-        "password": password
+        "password": hash_password(password)
     })
 
+def is_admin():
+    # Admins are flagged by hand with "admin": true on their user record;
+    # an email match alone proves nothing since signup is unverified
+    if "user" not in session:
+        return False
+    user = get_user(session["user"])
+    return bool(user and user.get("admin") is True)
+
+class UserExistsError(Exception):
+    pass
+
+def create_user(email, name, password):
+    # Checks for an existing account and writes the new one atomically;
+    # the password is only hashed once the key is known to be free
+    user = {}
+
+    def create(existing):
+        if existing:
+            raise UserExistsError(email)
+        if not user:
+            user.update(name=name, password=hash_password(password))
+        return user
+
+    user_cache.pop(email, None)
+    g.pop("user_cache", None)
+    try:
+        db.reference(f"users/{format_email_key(email)}").transaction(create)
+    except UserExistsError:
+        return False
+    return True
+
+def check_password(email, user, password):
+    stored = user["password"]
+
+    if not stored.startswith("$argon2"):
+        # Accounts created before hashing still hold the plain password;
+        # upgrade them on their next successful login
+        if not hmac.compare_digest(stored.encode(), password.encode()):
+            return False
+        save_user(email, user["name"], password)
+        return True
+
+    if not verify_password(stored, password):
+        return False
+
+    if password_hasher.check_needs_rehash(stored):
+        save_user(email, user["name"], password)
+    return True
+
 def save_booking(category, email, data):
     db.reference(f"bookings/{category}").push({
         "user": email,
         **data
     })
 
-def get_all_reviews():
-    return list((db.reference("reviews").get() or {}).values())
+class ReviewExistsError(Exception):
+    pass
+
+def has_review(email):
+    # Queries the "user" child so this also finds reviews saved under push
+    # IDs before reviews were keyed by user. Firebase rejects the query
+    # until the index in database.rules.json is deployed; scan meanwhile.
+    try:
+        reviews = db.reference("reviews").order_by_child("user").equal_to(email).limit_to_first(1).get()
+    except exceptions.InvalidArgumentError:
+        app.logger.warning("reviews/.indexOn user missing, deploy database.rules.json")
+        reviews = db.reference("reviews").get() or {}
+        return any(r.get("user") == email for r in reviews.values())
+    return bool(reviews)
 
 def save_review(email, name, review, rating):
-    db.reference("reviews").push({
+    # Writes the review only if this user has none yet, atomically
+    record = {
         "user": email,
         "name": name,
         "review": review,
         "rating": rating
-    })
+    }
+
+    def create(existing):
+        if existing:
+            raise ReviewExistsError(email)
+        return record
+
+    try:
+        db.reference(f"reviews/{format_email_key(email)}").transaction(create)
+    except ReviewExistsError:
+        return False
+    return True
 
 def save_contact_message(name, email, phone, message):
     db.reference("contact_messages").push({
@@ -91,33 +335,41 @@ def save_contact_message(name, email, phone, message):
         "email": email,
         "phone": phone,
         "message": message,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": int(time.time() * 1000)
     })
 
-def get_all_contact_messages():
-    messages = db.reference("contact_messages").get() or {}
-    return sorted(messages.values(), key=lambda x: x.get("timestamp", ""), reverse=True)
+@cache.memoize(timeout=30)
+def get_all_contact_messages(limit=50):
+    # Newest first; push IDs are chronological, so Firebase can order and
+    # limit by key without an index or relying on the timestamp format
+    messages = db.reference("contact_messages").order_by_key().limit_to_last(limit).get() or {}
+    return list(reversed(list(messages.values())))
 
 # ---------------------------------------
 # PUBLIC ROUTES
 # ---------------------------------------
 @app.route("/")
+@cache.cached(timeout=600, unless=is_personalised)
 def index():
     return render_template("index.html")
 
 @app.route("/about")
+@cache.cached(timeout=600, unless=is_personalised)
 def about():
     return render_template("about.html")
 
 @app.route("/gallery")
+@cache.cached(timeout=600, unless=is_personalised)
 def gallery():
     return render_template("gallery.html")
 
 @app.route("/map")
+@cache.cached(timeout=600, unless=is_personalised)
 def map_page():
     return render_template("map.html")
 
 @app.route("/kids")
+@cache.cached(timeout=600, unless=is_personalised)
 def kids():
     return render_template("kids.html")
 
@@ -125,6 +377,7 @@ def kids():
 # CONTACT PAGE
 # ---------------------------------------
 @app.route("/contact", methods=["GET", "POST"])
+@cache.cached(timeout=30, unless=is_personalised)
 def contact():
     if request.method == "POST":
 
@@ -144,7 +397,7 @@ def contact():
         # Admin email
         send_email(
             "New Contact Message",
-            os.getenv("MAIL_USERNAME"),
+            ADMIN_EMAIL,
             f"Name: {user_name}\nEmail: {email}\nPhone: {phone}\nMessage:\n{message}"
         )
 
@@ -158,8 +411,16 @@ def contact():
         flash("Your message has been sent!", "success")
         return redirect(url_for("contact"))
 
-    messages = get_all_contact_messages()
-    return render_template("contact.html", messages=messages)
+    return render_template("contact.html", show_messages=is_admin())
+
+# Loaded by contact.html after the page renders, for admins only
+@app.route("/contact/messages")
+def contact_messages():
+    if not is_admin():
+        abort(403)
+
+    limit = max(1, min(request.args.get("limit", 20, type=int), 50))
+    return jsonify(get_all_contact_messages(limit))
 
 # ---------------------------------------
 # REVIEWS PAGE
@@ -172,20 +433,25 @@ def reviews_page():
 
         email = session["user"]
 
+        # Look up the existing review while the user record is fetched
+        existing_review = gevent.spawn(has_review, email)
+        name = get_user(email)["name"]
+
         # One review per user
-        if any(r["user"] == email for r in get_all_reviews()):
+        if existing_review.get():
             flash("You have already submitted a review.", "error")
             return redirect(url_for("reviews_page"))
 
         review = request.form["review"]
         rating = request.form["rating"]
-        name = get_user(email)["name"]
 
-        save_review(email, name, review, rating)
+        if not save_review(email, name, review, rating):
+            flash("You have already submitted a review.", "error")
+            return redirect(url_for("reviews_page"))
 
         send_email(
             "New Review Submitted",
-            os.getenv("MAIL_USERNAME"),
+            ADMIN_EMAIL,
             f"User: {email}\nName: {name}\nRating: {rating}\nReview: {review}"
         )
 
@@ -204,11 +470,10 @@ def signup():
         email = request.form["email"]
         password = request.form["password"]
 
-        if get_user(email):
+        if not create_user(email, name, password):
             flash("User already exists", "error")
             return redirect(url_for("signup"))
 
-        save_user(email, name, password)
         flash("Signup successful!", "success")
         return redirect(url_for("login"))
 
@@ -227,7 +492,7 @@ def login():
 
         user = get_user(email)
 
-        if not user or user["password"] != password:
+        if not user or not check_password(email, user, password):
             flash("Incorrect email or password", "error")
             return redirect(url_for("login"))
 
@@ -266,9 +531,8 @@ def book_hunt():
 
         save_booking("hunt", email, data)
 
-        send_email(
+        notify_admin(
             "New Hunt Booking",
-            os.getenv("MAIL_USERNAME"),
             f"User: {email}\nName: {data['first_name']}\nContact: {data['contact']}\nDate: {data['hunt_date']}"
         )
 
@@ -296,9 +560,8 @@ def accommodation():
 
         save_booking("accommodation", email, data)
 
-        send_email(
+        notify_admin(
             "New Accommodation Booking",
-            os.getenv("MAIL_USERNAME"),
             f"User: {email}\nName: {data['first_name']}\nContact: {data['contact']}\nCheck-In: {data['checkin_date']}"
         )
 
@@ -327,9 +590,8 @@ def water():
 
         save_booking("water", email, data)
 
-        send_email(
+        notify_admin(
             "New Water Order",
-            os.getenv("MAIL_USERNAME"),
             f"User: {email}\nName: {data['first_name']}\nContact: {data['contact']}\nOrder: {data['product_quantity']}\nLocation: {data['location']}"
         )
 
@@ -340,5 +602,10 @@ def water():
 # ---------------------------------------
 # RUN SERVER
 # ---------------------------------------
+# Production runs under gunicorn (see Procfile and wsgi.py)
 if __name__ == "__main__":
-    app.run(debug=True)
+    if os.getenv("FLASK_ENV") == "development":
+        app.run(debug=True)
+    else:
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(("0.0.0.0", 5000), app).serve_forever()